@@ -4,26 +4,30 @@ Użycie lokalne (wymaga instalacji fastapi+uvicorn):
     pip install fastapi uvicorn
     uvicorn backend.api:app --reload
 """
-from fastapi import FastAPI, UploadFile, File, Form
-from typing import List
-import io, csv
+from fastapi import FastAPI, UploadFile, File, Form, Query
+from fastapi.responses import StreamingResponse
+from typing import List, Literal
 
-from .app import allocate_costs, _read_csv_any, REQUIRED_COA_COLS, REQUIRED_COST_COLS, REQUIRED_ALLOCATION_COLS
+from .app import allocate_costs, iter_csv_chunks, _read_csv_any, REQUIRED_COA_COLS, REQUIRED_COST_COLS, REQUIRED_ALLOCATION_COLS
 
 app = FastAPI(title="Controlling Allocation API")
 
 def read_uploaded_csv(file: UploadFile, req_cols):
-    content = file.file.read().decode("utf-8")
-    return _read_csv_any(io.StringIO(content), req_cols)
+    return _read_csv_any(file.file, req_cols)
 
 @app.post("/allocate")
 async def allocate(
     coa: UploadFile = File(...),
     costs: UploadFile = File(...),
     alloc: UploadFile | None = File(None),
+    fmt: Literal["json", "csv"] = Query("json", alias="format"),
 ):
     coa_rows = read_uploaded_csv(coa, REQUIRED_COA_COLS)
     costs_rows = read_uploaded_csv(costs, REQUIRED_COST_COLS)
     alloc_rows = read_uploaded_csv(alloc, REQUIRED_ALLOCATION_COLS) if alloc else []
     result, notes = allocate_costs(coa_rows, costs_rows, alloc_rows)
+    if fmt == "csv":
+        # Wynik strumieniowany w kawałkach, bez serializacji JSON; notatki tylko w formacie json.
+        return StreamingResponse(iter_csv_chunks(result), media_type="text/csv",
+                                 headers={"Content-Disposition": 'attachment; filename="alokacja.csv"'})
     return {"result": result, "notes": notes}
@@ -18,9 +18,11 @@ import csv
 import io
 import os
 import sys
-from collections import defaultdict
+from collections import Counter, defaultdict, deque
 from dataclasses import dataclass
-from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+from itertools import chain
+from operator import attrgetter, itemgetter
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
 
 REQUIRED_COA_COLS: Dict[str, Sequence[str]] = {
     "account_id": ["account_id", "konto", "id", "AccountID", "Account Id", "Konto"],
@@ -39,12 +41,17 @@ REQUIRED_ALLOCATION_COLS: Dict[str, Sequence[str]] = {
     "weight": ["weight", "udzial", "klucz", "proporcja", "wspolczynnik", "Udział", "Klucz"],
 }
 
-def _lower_map(header: Iterable[str]) -> Dict[str, str]:
-    return {h.lower().strip(): h for h in header}
+RESULT_COLS: List[str] = ["account_id", "parent_id", "name", "amount"]
+CSV_CHUNK_SIZE = 64 * 1024
 
-def _auto_map_columns_row(row: Dict[str, str], required_map: Dict[str, Sequence[str]]) -> Dict[str, str]:
-    lh = _lower_map(row.keys())
-    out: Dict[str, str] = {}
+_DELIMITERS = ",;\t|"
+
+def _lower_map(header: Iterable[str]) -> Dict[str, int]:
+    return {h.lower().strip(): i for i, h in enumerate(header)}
+
+def _resolve_columns(header: Iterable[str], required_map: Dict[str, Sequence[str]]) -> Dict[str, int]:
+    lh = _lower_map(header)
+    out: Dict[str, int] = {}
     for internal, candidates in required_map.items():
         found_key = None
         for cand in candidates:
@@ -52,37 +59,49 @@ def _auto_map_columns_row(row: Dict[str, str], required_map: Dict[str, Sequence[
             if key in lh:
                 found_key = lh[key]
                 break
-        if not found_key:
+        if found_key is None:
             raise ValueError(
                 f"Brak wymaganej kolumny dla '{internal}'. Dozwolone nagłówki: {', '.join(candidates)}."
             )
-        out[internal] = row.get(found_key, "")
+        out[internal] = found_key
     return out
 
 def _sniff_delimiter(sample: str) -> str:
-    try:
-        dialect = csv.Sniffer().sniff(sample, delimiters=",;\t|")
-        return dialect.delimiter
-    except Exception:
-        return ","
+    # Zliczanie znaków w nagłówku zamiast csv.Sniffer – jego wyrażenia regularne
+    # potrafią długo się zapętlać na nietypowych danych.
+    first_line = sample.splitlines()[0] if sample else ""
+    # Liczymy tylko poza cudzysłowami – nazwy kolumn mogą zawierać separatory.
+    first_line = "".join(first_line.split('"')[::2])
+    delim = max(_DELIMITERS, key=first_line.count)
+    return delim if first_line.count(delim) else ","
+
+def _read_csv_lines(lines: Iterable[str], required_cols: Dict[str, Sequence[str]]) -> List[Dict[str, str]]:
+    it = iter(lines)
+    # Separator wykrywany z tego samego wiersza, który csv.reader weźmie za nagłówek.
+    header = next((line for line in it if line.strip()), "")
+    delim = _sniff_delimiter(header)
+    reader = csv.reader(chain([header], it), delimiter=delim)
+    fieldnames = next((r for r in reader if r), None)
+    if fieldnames is None:
+        return []
+    # Nagłówek jest wspólny dla wszystkich wierszy – indeksy kolumn liczone raz.
+    mapping = _resolve_columns(fieldnames, required_cols)
+    width = max(mapping.values()) + 1
+    items = list(mapping.items())
+    padded = (r if len(r) >= width else r + [""] * (width - len(r)) for r in reader if r)
+    # Wartości przycinane tutaj, raz – dalszy kod dostaje już czyste napisy.
+    return [{internal: row[i].strip() for internal, i in items} for row in padded]
+
+def _decode_lines(buffer) -> Iterable[str]:
+    for line in buffer:
+        yield line.decode("utf-8") if isinstance(line, bytes) else line
 
 def _read_csv_any(file_path_or_buffer, required_cols: Dict[str, Sequence[str]]) -> List[Dict[str, str]]:
+    # Plik czytany strumieniowo, linia po linii – bez wczytywania całości do pamięci.
     if hasattr(file_path_or_buffer, "read"):
-        content = file_path_or_buffer.read()
-        if isinstance(content, bytes):
-            content = content.decode("utf-8")
-        text = content
-    else:
-        with open(file_path_or_buffer, "r", encoding="utf-8") as f:
-            text = f.read()
-
-    delim = _sniff_delimiter(text[:2048])
-    reader = csv.DictReader(io.StringIO(text), delimiter=delim)
-    rows: List[Dict[str, str]] = []
-    for raw in reader:
-        mapped = _auto_map_columns_row(raw, required_cols)
-        rows.append(mapped)
-    return rows
+        return _read_csv_lines(_decode_lines(file_path_or_buffer), required_cols)
+    with open(file_path_or_buffer, "r", encoding="utf-8", newline="") as f:
+        return _read_csv_lines(f, required_cols)
 
 def _read_table(file_path: str, required_cols: Dict[str, Sequence[str]]) -> List[Dict[str, str]]:
     ext = os.path.splitext(getattr(file_path, "name", file_path))[1].lower()
@@ -93,65 +112,101 @@ def _read_table(file_path: str, required_cols: Dict[str, Sequence[str]]) -> List
     else:
         raise ValueError("Obsługiwane formaty wejścia: CSV/TXT.")
 
+_NUM_TRANS = str.maketrans({" ": None, ",": "."})
+
 def _to_float(val: str) -> float:
-    s = (val or "").strip()
+    s = (val or "").strip().translate(_NUM_TRANS)
     if not s:
         return 0.0
-    s = s.replace(" ", "").replace(",", ".")
     try:
         return float(s)
     except ValueError:
         raise ValueError(f"Nieprawidłowa liczba: '{val}'")
 
-@dataclass
+def _to_floats(values: Iterable[str]) -> List[float]:
+    """Zbiorcza wersja _to_float: jedno translate i map(float) dla całej kolumny.
+
+    Jeśli któraś wartość jest pusta lub błędna, per wartość sprawdzane są tylko te, które nie przeszły.
+    """
+    vals = list(values)
+    cleaned = "\0".join(vals).translate(_NUM_TRANS).split("\0")
+    if len(cleaned) != len(vals):
+        return [_to_float(v) for v in vals]
+    try:
+        return list(map(float, cleaned))
+    except ValueError:
+        pass
+    out: List[float] = []
+    for c, v in zip(cleaned, vals):
+        try:
+            out.append(float(c))
+        except ValueError:
+            out.append(_to_float(v))
+    return out
+
+@dataclass(slots=True)
 class Account:
     account_id: str
     parent_id: str
     name: str
 
-def validate_tree(coa_rows: List[Dict[str, str]]):
+@dataclass
+class CoaIndex:
+    """Plan kont przetworzony raz – współdzielony przez validate_tree i allocate_costs."""
+    accounts: List[Account]
+    ids: set[str]
+    children: Dict[str, List[str]]
+
+def _build_coa(coa_rows: List[Dict[str, str]]) -> CoaIndex:
+    accounts: List[Account] = [
+        Account(account_id=r["account_id"], parent_id=r["parent_id"], name=r["name"])
+        for r in coa_rows
+    ]
+    children: Dict[str, List[str]] = defaultdict(list)
+    for a in accounts:
+        children[a.parent_id].append(a.account_id)
+    return CoaIndex(accounts=accounts, ids={a.account_id for a in accounts}, children=dict(children))
+
+def validate_tree(coa_rows: List[Dict[str, str]] | CoaIndex):
+    coa = coa_rows if isinstance(coa_rows, CoaIndex) else _build_coa(coa_rows)
     msgs: List[str] = []
-    ids: List[str] = [str(r["account_id"]).strip() for r in coa_rows]
-    parents: List[str] = [str((r.get("parent_id") or "")).strip() for r in coa_rows]
-
-    seen: Dict[str, int] = defaultdict(int)
-    dups: List[str] = []
-    for i in ids:
-        seen[i] += 1
-        if seen[i] == 2:
-            dups.append(i)
+    ids: List[str] = [a.account_id for a in coa.accounts]
+    parents: List[str] = [a.parent_id for a in coa.accounts]
+    children = coa.children
+
+    dups = [i for i, n in Counter(ids).items() if n > 1]
     if dups:
         msgs.append(f"Zduplikowane identyfikatory kont: {sorted(dups)}")
 
-    idset = set(ids)
-    bad_parents = sorted({p for p in parents if p and p not in idset})
+    idset = coa.ids
+    bad_parents = sorted(set(parents).difference(idset, {""}))
     if bad_parents:
         msgs.append("Wskazano parent_id, których nie ma w wykazie kont: " + ", ".join(bad_parents))
 
-    children: Dict[str, List[str]] = defaultdict(list)
-    for acc, par in zip(ids, parents):
-        children[par].append(acc)
-
     visiting: set[str] = set()
     visited: set[str] = set()
 
-    def dfs(node: str) -> bool:
-        if node in visiting:
-            return True
-        if node in visited:
-            return False
-        visiting.add(node)
-        for ch in children.get(node, []):
-            if dfs(ch):
-                return True
-        visiting.remove(node)
-        visited.add(node)
+    def has_cycle_from(start: str) -> bool:
+        visiting.add(start)
+        stack = [(start, iter(children.get(start, [])))]
+        while stack:
+            node, it = stack[-1]
+            for ch in it:
+                if ch in visiting:
+                    return True
+                if ch not in visited:
+                    visiting.add(ch)
+                    stack.append((ch, iter(children.get(ch, []))))
+                    break
+            else:
+                stack.pop()
+                visiting.remove(node)
+                visited.add(node)
         return False
 
     has_cycle = False
-    roots = set(parents) | {""}
-    for r in roots:
-        if dfs(r):
+    for node in list(children) + ids:
+        if node not in visited and has_cycle_from(node):
             has_cycle = True
             break
     if has_cycle:
@@ -159,85 +214,168 @@ def validate_tree(coa_rows: List[Dict[str, str]]):
 
     return (len(msgs) == 0, msgs)
 
-def _normalize_weights(alloc_rows: List[Dict[str, str]]):
+def _normalize_weights(alloc_rows: List[Dict[str, str]], children: Dict[str, List[str]]):
+    """Normalizuje wagi per rodzic, pomijając klucze do kont, które nie są jego dziećmi.
+
+    Zwraca (wagi, rodzice z zerową sumą wag) – tych drugich nie da się rozksięgować.
+    """
+    direct: Dict[str, set[str]] = {p: set(chs) for p, chs in children.items()}
     per_parent: Dict[str, List[Tuple[str, float]]] = defaultdict(list)
     tmp_sum: Dict[str, float] = defaultdict(float)
 
     for r in alloc_rows:
-        p = str(r["parent_id"]).strip()
-        c = str(r["child_id"]).strip()
-        w = _to_float(str(r["weight"]))
-        per_parent[p].append((c, w))
-        tmp_sum[p] += w
+        p = r["parent_id"]
+        c = r["child_id"]
+        w = _to_float(r["weight"])
+        lst = per_parent[p]
+        if c in direct.get(p, ()):
+            lst.append((c, w))
+            tmp_sum[p] += w
 
     out: Dict[str, List[Tuple[str, float]]] = {}
+    empty_parents: set[str] = set()
     for p, lst in per_parent.items():
-        s = tmp_sum[p] if tmp_sum[p] != 0 else 1.0
+        s = tmp_sum[p]
+        if s == 0:
+            empty_parents.add(p)
+            s = 1.0
         out[p] = [(c, (w / s)) for (c, w) in lst]
-    return out
+    return out, empty_parents
 
 from typing import Tuple
 
-def allocate_costs(coa_rows, costs_rows, alloc_rows, *, max_iters: int = 10000) -> Tuple[List[Dict[str, str]], List[str]]:
-    notes: List[str] = []
-
-    accounts: List[Account] = [
-        Account(account_id=str(r["account_id"]).strip(),
-                parent_id=str((r.get("parent_id") or "")).strip(),
-                name=str((r.get("name") or "")).strip())
-        for r in coa_rows
-    ]
-    children: Dict[str, List[str]] = defaultdict(list)
-    for a in accounts:
-        children[a.parent_id].append(a.account_id)
-
-    amt: Dict[str, float] = defaultdict(float)
-    for r in costs_rows:
-        acc = str(r["account_id"]).strip()
-        amt[acc] += _to_float(str(r["amount"]))
-
-    for a in accounts:
-        _ = amt[a.account_id]
-
-    alloc_norm = _normalize_weights(alloc_rows)
-
-    alloc_map: Dict[str, List[Tuple[str, float]]] = {}
-    for p, lst in alloc_norm.items():
-        direct = set(children.get(p, []))
-        filt = [(c, w) for (c, w) in lst if c in direct]
-        alloc_map[p] = filt
-
-    it = 0
-    progress = True
-    while progress and it < max_iters:
-        it += 1
-        progress = False
-        parents_ready = [p for p, lst in alloc_map.items() if amt.get(p, 0.0) != 0.0 and lst]
-        if not parents_ready:
-            break
-        for p in parents_ready:
-            amount = amt.get(p, 0.0)
-            if amount == 0.0:
-                continue
-            targets = alloc_map.get(p, [])
-            s = sum(w for _, w in targets)
-            if s <= 0 or not targets:
-                notes.append(f"Konto '{p}' ma niewłaściwe/zerowe wagi albo brak dzieci – pomijam alokację.")
+def _cycle_members(children: Dict[str, List[str]], nodes: set[str]) -> set[str]:
+    """Zwraca konta leżące na cyklu spośród `nodes` (kont nieosiągalnych z korzeni).
+
+    Iteracyjnie odcina liście; zostają tylko konta, z których da się wrócić do cyklu.
+    """
+    out_deg: Dict[str, int] = {}
+    parents_of: Dict[str, List[str]] = defaultdict(list)
+    for n in nodes:
+        chs = [c for c in children.get(n, []) if c in nodes]
+        out_deg[n] = len(chs)
+        for c in chs:
+            parents_of[c].append(n)
+    stack = [n for n, d in out_deg.items() if d == 0]
+    remaining = set(nodes)
+    while stack:
+        n = stack.pop()
+        remaining.discard(n)
+        for p in parents_of.get(n, []):
+            out_deg[p] -= 1
+            if out_deg[p] == 0:
+                stack.append(p)
+    return remaining
+
+def _topological_order(children: Dict[str, List[str]], ids: set[str]) -> Tuple[List[str], List[str]]:
+    """Kolejność od korzeni w dół (BFS) oraz posortowana lista kont leżących na cyklach.
+
+    Konta z cyklu nie trafiają do kolejności, ale poddrzewa zawieszone pod cyklem – tak.
+    """
+    seen: set[str] = set()
+    order: List[str] = []
+
+    def walk(seeds: Iterable[str]) -> None:
+        queue = deque(seeds)
+        while queue:
+            node = queue.popleft()
+            if node in seen:
                 continue
-            for c, w in targets:
-                amt[c] = amt.get(c, 0.0) + amount * (w / s)
-            amt[p] = 0.0
-            progress = True
-
-    if it >= max_iters:
-        notes.append("Osiągnięto limit iteracji – sprawdź, czy model nie powoduje pętli.")
+            seen.add(node)
+            order.append(node)
+            queue.extend(children.get(node, []))
+
+    walk(p for p in children if p not in ids)
+    unreached = ids - seen
+    if not unreached:
+        return order, []
+    cycle = _cycle_members(children, unreached)
+    seen |= cycle
+    walk(c for n in cycle for c in children.get(n, []) if c not in cycle)
+    return order, sorted(cycle)
+
+def _scatter_add(amt: List[float], indices: Iterable[int], values: Iterable[float]) -> None:
+    """amt[i] += v dla każdej pary; powtarzające się indeksy sumują się."""
+    for i, v in zip(indices, values):
+        amt[i] += v
+
+def _build_alloc_csr(order: Sequence[str], alloc_map: Dict[str, List[Tuple[str, float]]],
+                     empty_parents: set[str], id_of: Dict[str, int]):
+    """Spłaszcza klucze do list CSR (parents, row_ptr, child_idx, weights) w kolejności `order`."""
+    parents: List[int] = []
+    row_ptr: List[int] = [0]
+    child_idx: List[int] = []
+    weights: List[float] = []
+    for p in order:
+        targets = alloc_map.get(p)
+        if targets is None or p not in id_of:
+            continue
+        parents.append(id_of[p])
+        if p not in empty_parents:
+            child_idx.extend(id_of[c] for c, _ in targets)
+            weights.extend(w for _, w in targets)
+        row_ptr.append(len(child_idx))
+    return parents, row_ptr, child_idx, weights
+
+def _allocate_kernel(amt: List[float], parents: Sequence[int], row_ptr: Sequence[int],
+                     child_idx: Sequence[int], weights: Sequence[float]) -> None:
+    """Rozksięgowuje `amt` w miejscu; krawędzie rodzica parents[k] to child_idx/weights[row_ptr[k]:row_ptr[k+1]].
+
+    Rodzice muszą być podani w kolejności topologicznej; pusty wiersz zostawia kwotę na rodzicu.
+    """
+    for k, p in enumerate(parents):
+        amount = amt[p]
+        start, end = row_ptr[k], row_ptr[k + 1]
+        if amount == 0.0 or start == end:
+            continue
+        for i in range(start, end):
+            amt[child_idx[i]] += amount * weights[i]
+        amt[p] = 0.0
+
+def allocate_costs(coa_rows, costs_rows, alloc_rows, *, max_iters: Optional[int] = None) -> Tuple[List[Dict[str, str]], List[str]]:
+    # max_iters nie jest już używany (alokacja to jeden przebieg) – zostaje dla zgodności wywołań.
+    coa = coa_rows if isinstance(coa_rows, CoaIndex) else _build_coa(coa_rows)
+    notes: List[str] = []
+    accounts, children = coa.accounts, coa.children
+
+    # Kwoty trzymane w liście indeksowanej numerem konta zamiast w słowniku;
+    # nodes[i] to konto, do którego należy amt[i].
+    # Posortowane raz na wejściu, więc wynik powstaje już w kolejności (parent_id, account_id).
+    nodes: List[Account] = sorted({a.account_id: a for a in accounts}.values(),
+                                  key=attrgetter("parent_id", "account_id"))
+    n_coa = len(nodes)
+    id_of: Dict[str, int] = {a.account_id: i for i, a in enumerate(nodes)}
+    cost_ids = [r["account_id"] for r in costs_rows]
+    for acc in cost_ids:
+        if acc not in id_of:
+            id_of[acc] = len(nodes)
+            nodes.append(Account(acc, "", ""))
+    amt: List[float] = [0.0] * len(nodes)
+    _scatter_add(amt, map(id_of.__getitem__, cost_ids), _to_floats(r["amount"] for r in costs_rows))
+
+    alloc_map, empty_parents = _normalize_weights(alloc_rows, children)
+
+    # Alokacja trafia wyłącznie do bezpośrednich dzieci, więc jeden przebieg
+    # od korzeni w dół rozksięgowuje całe drzewo.
+    ids = coa.ids
+    order, cycle = _topological_order(children, ids)
+    parents, row_ptr, child_idx, weights = _build_alloc_csr(order, alloc_map, empty_parents, id_of)
+    _allocate_kernel(amt, parents, row_ptr, child_idx, weights)
+
+    for p in order:
+        if p in empty_parents and p in id_of and amt[id_of[p]] != 0.0:
+            notes.append(f"Konto '{p}' ma niewłaściwe/zerowe wagi albo brak dzieci – pomijam alokację.")
+
+    in_cycle = [p for p in cycle if p in alloc_map]
+    if in_cycle:
+        notes.append("Konta w cyklu pominięte w alokacji: " + ", ".join(in_cycle))
 
-    by_id: Dict[str, Account] = {a.account_id: a for a in accounts}
     result: List[Dict[str, str]] = []
-    for acc_id, amount in amt.items():
-        a = by_id.get(acc_id, Account(acc_id, "", ""))
-        result.append({"account_id": a.account_id, "parent_id": a.parent_id, "name": a.name, "amount": f"{amount:.6f}"})
-    result.sort(key=lambda r: (r.get("parent_id", ""), r.get("account_id", "")))
+    for a, amount in zip(nodes, amt):
+        result.append(dict(zip(RESULT_COLS, (a.account_id, a.parent_id, a.name, f"{amount:.6f}"))))
+    if len(nodes) > n_coa:
+        # Konta spoza planu kont (tylko w kosztach) dopisano na końcu – trzeba je wpasować.
+        result.sort(key=itemgetter("parent_id", "account_id"))
     return result, notes
 
 def write_csv(path: str, rows: List[Dict[str, str]]) -> None:
@@ -252,6 +390,19 @@ def write_csv(path: str, rows: List[Dict[str, str]]) -> None:
         for r in rows:
             w.writerow(r)
 
+def iter_csv_chunks(rows: List[Dict[str, str]], chunk_size: int = CSV_CHUNK_SIZE) -> Iterator[str]:
+    """Zwraca wynik jako CSV w kawałkach po ok. `chunk_size` znaków (nagłówek zawsze obecny)."""
+    buf = io.StringIO()
+    w = csv.DictWriter(buf, fieldnames=RESULT_COLS)
+    w.writeheader()
+    for r in rows:
+        w.writerow(r)
+        if buf.tell() > chunk_size:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
 def write_templates(prefix: str = "") -> None:
     coa = [
         {"account_id": "100", "parent_id": "", "name": "Koszty ogólne"},
@@ -298,7 +449,8 @@ def run_cli(args: argparse.Namespace) -> int:
         print(f"[BŁĄD] Problem z odczytem danych: {e}", file=sys.stderr)
         return 3
 
-    ok, msgs = validate_tree(coa_rows)
+    coa = _build_coa(coa_rows)
+    ok, msgs = validate_tree(coa)
     if not ok:
         print("[UWAGA] Walidacja planu kont zwróciła ostrzeżenia/błędy:")
         for m in msgs:
@@ -306,7 +458,7 @@ def run_cli(args: argparse.Namespace) -> int:
         if args.validate_only:
             return 4
 
-    result, notes = allocate_costs(coa_rows, costs_rows, alloc_rows)
+    result, notes = allocate_costs(coa, costs_rows, alloc_rows)
 
     if not args.keep_zero:
         result = [r for r in result if round(float(r["amount"]), 2) != 0.0]
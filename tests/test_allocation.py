@@ -1,5 +1,7 @@
+import io
 import unittest
-from backend.app import allocate_costs, validate_tree
+from backend.app import (allocate_costs, validate_tree, iter_csv_chunks, _build_coa, _read_csv_any,
+                         CSV_CHUNK_SIZE, REQUIRED_COA_COLS, REQUIRED_COST_COLS)
 
 class AllocationTests(unittest.TestCase):
     def test_simple_chain_full_allocation(self):
@@ -106,6 +108,37 @@ class AllocationTests(unittest.TestCase):
         self.assertAlmostEqual(m.get("20", 0.0), 10.0, places=6)
         self.assertTrue(any("wagi" in n.lower() for n in notes))
 
+    def test_negative_weights_are_normalized(self):
+        coa = [
+            {"account_id": "25", "parent_id": "", "name": "R"},
+            {"account_id": "26", "parent_id": "25", "name": "C1"},
+            {"account_id": "27", "parent_id": "25", "name": "C2"},
+        ]
+        costs = [{"account_id": "25", "amount": "100"}]
+        alloc = [
+            {"parent_id": "25", "child_id": "26", "weight": "-1"},
+            {"parent_id": "25", "child_id": "27", "weight": "-3"},
+        ]
+        out, notes = allocate_costs(coa, costs, alloc)
+        m = {r["account_id"]: float(r["amount"]) for r in out}
+        self.assertAlmostEqual(m.get("26", 0.0), 25.0, places=6)
+        self.assertAlmostEqual(m.get("27", 0.0), 75.0, places=6)
+        self.assertEqual(notes, [])
+
+    def test_blank_amount_is_zero_and_invalid_amount_raises(self):
+        coa = [{"account_id": "35", "parent_id": "", "name": "R"}]
+        costs = [
+            {"account_id": "35", "amount": "1 000,5"},
+            {"account_id": "35", "amount": ""},
+            {"account_id": "35", "amount": "2"},
+        ]
+        out, _ = allocate_costs(coa, costs, [])
+        m = {r["account_id"]: float(r["amount"]) for r in out}
+        self.assertAlmostEqual(m.get("35", 0.0), 1002.5, places=6)
+        costs.append({"account_id": "35", "amount": "abc"})
+        with self.assertRaisesRegex(ValueError, "Nieprawidłowa liczba: 'abc'"):
+            allocate_costs(coa, costs, [])
+
     def test_multiple_initial_cost_rows_are_aggregated(self):
         coa = [
             {"account_id": "30", "parent_id": "", "name": "R"},
@@ -130,5 +163,132 @@ class AllocationTests(unittest.TestCase):
         self.assertAlmostEqual(m.get("40", 0.0), 9.0, places=6)
         self.assertTrue(any("brak dzieci" in n.lower() for n in notes))
 
+    def test_deep_chain_allocated_in_single_pass(self):
+        depth = 3000
+        coa = [{"account_id": "0", "parent_id": "", "name": "R"}]
+        alloc = []
+        for i in range(1, depth):
+            coa.append({"account_id": str(i), "parent_id": str(i - 1), "name": f"N{i}"})
+            alloc.append({"parent_id": str(i - 1), "child_id": str(i), "weight": "1"})
+        costs = [{"account_id": "0", "amount": "100"}]
+        out, notes = allocate_costs(coa, costs, alloc)
+        m = {r["account_id"]: float(r["amount"]) for r in out}
+        self.assertAlmostEqual(m.get(str(depth - 1), 0.0), 100.0, places=6)
+        self.assertAlmostEqual(m.get("0", 0.0), 0.0, places=6)
+        self.assertEqual(notes, [])
+        out_legacy, _ = allocate_costs(coa, costs, alloc, max_iters=10)
+        self.assertEqual(out_legacy, out)
+
+    def test_validate_tree_deep_chain_without_recursion_limit(self):
+        coa = [{"account_id": "0", "parent_id": "", "name": "R"}]
+        coa += [{"account_id": str(i), "parent_id": str(i - 1), "name": f"N{i}"} for i in range(1, 5000)]
+        ok, msgs = validate_tree(coa)
+        self.assertTrue(ok, msgs)
+        coa[0]["parent_id"] = "4999"
+        ok, msgs = validate_tree(coa)
+        self.assertFalse(ok)
+        self.assertTrue(any("cykl" in m.lower() for m in msgs))
+
+    def test_subtree_below_cycle_is_still_allocated(self):
+        coa = [
+            {"account_id": "A", "parent_id": "B", "name": "A"},
+            {"account_id": "B", "parent_id": "A", "name": "B"},
+            {"account_id": "C", "parent_id": "A", "name": "C"},
+            {"account_id": "D", "parent_id": "C", "name": "D"},
+        ]
+        costs = [{"account_id": "C", "amount": "10"}]
+        alloc = [
+            {"parent_id": "C", "child_id": "D", "weight": "1"},
+            {"parent_id": "A", "child_id": "C", "weight": "1"},
+        ]
+        out, notes = allocate_costs(coa, costs, alloc)
+        m = {r["account_id"]: float(r["amount"]) for r in out}
+        self.assertAlmostEqual(m.get("D", 0.0), 10.0, places=6)
+        self.assertAlmostEqual(m.get("C", 0.0), 0.0, places=6)
+        self.assertIn("Konta w cyklu pominięte w alokacji: A", notes)
+
+    def test_result_sorted_by_parent_then_account(self):
+        coa = [
+            {"account_id": "52", "parent_id": "50", "name": "B"},
+            {"account_id": "50", "parent_id": "", "name": "R"},
+            {"account_id": "51", "parent_id": "50", "name": "A"},
+        ]
+        costs = [{"account_id": "50", "amount": "1"}, {"account_id": "49", "amount": "2"}]
+        out, _ = allocate_costs(coa, costs, [])
+        self.assertEqual([(r["parent_id"], r["account_id"]) for r in out],
+                         [("", "49"), ("", "50"), ("50", "51"), ("50", "52")])
+
+    def test_prebuilt_coa_index_is_shared(self):
+        coa = _build_coa([
+            {"account_id": "60", "parent_id": "", "name": "R"},
+            {"account_id": "61", "parent_id": "60", "name": "A"},
+        ])
+        ok, msgs = validate_tree(coa_rows=coa)
+        self.assertTrue(ok, msgs)
+        out, _ = allocate_costs(coa_rows=coa,
+                                costs_rows=[{"account_id": "60", "amount": "8"}],
+                                alloc_rows=[{"parent_id": "60", "child_id": "61", "weight": "1"}])
+        m = {r["account_id"]: float(r["amount"]) for r in out}
+        self.assertAlmostEqual(m.get("61", 0.0), 8.0, places=6)
+
+    def test_read_csv_detects_semicolon_delimiter(self):
+        text = "Konto;Kwota\n100;1 234,56\n110;7\n"
+        rows = _read_csv_any(io.StringIO(text), REQUIRED_COST_COLS)
+        self.assertEqual(rows, [
+            {"account_id": "100", "amount": "1 234,56"},
+            {"account_id": "110", "amount": "7"},
+        ])
+
+    def test_read_csv_pads_short_rows_with_empty_strings(self):
+        text = "account_id,parent_id,name\n1,,Root\n2,1\n"
+        rows = _read_csv_any(io.StringIO(text), REQUIRED_COA_COLS)
+        self.assertEqual(rows[1], {"account_id": "2", "parent_id": "1", "name": ""})
+
+    def test_read_csv_skips_blank_lines(self):
+        text = "\naccount_id,amount\n\n100,5\n\n101,6\n"
+        rows = _read_csv_any(io.StringIO(text), REQUIRED_COST_COLS)
+        self.assertEqual([r["account_id"] for r in rows], ["100", "101"])
+        text = "\n\nKonto;Kwota\n100;1,5\n\n101;6\n"
+        rows = _read_csv_any(io.StringIO(text), REQUIRED_COST_COLS)
+        self.assertEqual(rows, [
+            {"account_id": "100", "amount": "1,5"},
+            {"account_id": "101", "amount": "6"},
+        ])
+
+    def test_read_csv_header_only_with_wrong_columns_raises(self):
+        with self.assertRaisesRegex(ValueError, "Brak wymaganej kolumny dla 'amount'"):
+            _read_csv_any(io.StringIO("account_id,foo\n"), REQUIRED_COST_COLS)
+        self.assertEqual(_read_csv_any(io.StringIO(""), REQUIRED_COST_COLS), [])
+
+    def test_read_csv_ignores_delimiters_inside_quoted_header(self):
+        text = '"Konto";"Kwota, PLN";"x, y"\n100;5;a\n'
+        cols = {"account_id": ["konto"], "amount": ["kwota, pln"]}
+        rows = _read_csv_any(io.StringIO(text), cols)
+        self.assertEqual(rows, [{"account_id": "100", "amount": "5"}])
+
+    def test_read_csv_streams_binary_buffer(self):
+        data = "account_id,amount\r\n100,5\r\n101,\"1,5\"\r\n".encode("utf-8")
+        rows = _read_csv_any(io.BytesIO(data), REQUIRED_COST_COLS)
+        self.assertEqual(rows, [
+            {"account_id": "100", "amount": "5"},
+            {"account_id": "101", "amount": "1,5"},
+        ])
+
+    def test_iter_csv_chunks_header_only_for_empty_result(self):
+        self.assertEqual(list(iter_csv_chunks([])), ["account_id,parent_id,name,amount\r\n"])
+
+    def test_iter_csv_chunks_splits_large_result(self):
+        coa = [{"account_id": f"{i:06d}", "parent_id": "", "name": "x" * 40} for i in range(5000)]
+        out, _ = allocate_costs(coa, [], [])
+        chunks = list(iter_csv_chunks(out))
+        self.assertGreater(len(chunks), 1)
+        self.assertTrue(chunks[0].startswith("account_id,parent_id,name,amount\r\n"))
+        for c in chunks[:-1]:
+            self.assertGreater(len(c), CSV_CHUNK_SIZE)
+            self.assertLess(len(c), CSV_CHUNK_SIZE + 100)
+        lines = "".join(chunks).splitlines()
+        self.assertEqual(len(lines), 5001)
+        self.assertEqual(lines[1], "000000,,%s,0.000000" % ("x" * 40))
+
 if __name__ == "__main__":
     unittest.main()